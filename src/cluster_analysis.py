@@ -6,22 +6,57 @@ Performs clustering of segmented fan-model conversations using:
 - Method B: Hybrid embeddings (conversation + fan profile)
 
 Embeddings are generated via VoyageAI, clusters via KMeans, and visualized with UMAP and Plotly.
-Outputs are saved as pickles and visualizations.
+KMeans and UMAP run on GPU through cuML when it is installed.
+Outputs are saved as pickles, compressed npz embeddings and visualizations.
 """
 
 import pandas as pd
 import numpy as np
-from sklearn.cluster import KMeans
+from scipy import sparse
+
+try:
+    from cuml.cluster import KMeans as cuKMeans
+    from cuml.manifold import UMAP as cuUMAP
+    HAS_CUML = True
+except ImportError:
+    HAS_CUML = False
+    try:
+        from sklearnex import patch_sklearn
+        patch_sklearn()
+    except ImportError:
+        pass
+
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.compose import ColumnTransformer
+from sklearn.impute import SimpleImputer
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import OneHotEncoder, StandardScaler
 import umap
 import matplotlib.pyplot as plt
 import seaborn as sns
 import plotly.express as px
 from pathlib import Path
 import pickle
+import hashlib
+import os
+import sqlite3
+import random
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import voyageai
+from segmentation import enable_copy_on_write
 
 vo = voyageai.Client()
 N_CLUSTERS = 5
+MINIBATCH_THRESHOLD = 5000
+EMBED_MODEL = "voyage-3.5"
+EMBED_CACHE_PATH = "cache/embedding_cache.sqlite"
+PROFILE_TRANSFORMER_PATH = "cache/profile_transformer.pkl"
+EMBED_MAX_WORKERS = 6
+EMBED_MAX_RETRIES = 5
+EMBED_REQUESTS_PER_SECOND = 4
+os.makedirs(os.path.dirname(EMBED_CACHE_PATH), exist_ok=True)
 
 
 def load_data():
@@ -37,34 +72,145 @@ def get_stage_texts(df):
     """
     Concatenate fan messages for each fan-model stage to form long texts for embedding.
     """
-    grouped = df.groupby(["fan_model_id", "stage"])
-    return grouped['fan_message'].apply(lambda msgs: " ".join(msgs.dropna().astype(str))).reset_index(name='text')
+    messages = df.dropna(subset=['fan_message']).astype({'fan_message': 'string[pyarrow]'})
+    grouped = messages.groupby(["fan_model_id", "stage"], sort=False, observed=True)
+    return grouped['fan_message'].agg(" ".join).reset_index(name='text')
+
+
+def get_embedding_key(text):
+    """Generate SHA256 key of text and embedding model for caching."""
+    return hashlib.sha256((text + EMBED_MODEL).encode()).digest()
+
+
+def open_embedding_cache():
+    """Open the on-disk embedding cache, creating the table if needed."""
+    conn = sqlite3.connect(EMBED_CACHE_PATH)
+    conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, vec BLOB)")
+    return conn
+
+
+def load_cached_embeddings(conn, keys):
+    """Look up cached embeddings for the given keys; returns a dict of key -> vector."""
+    cached = {}
+    unique_keys = list(set(keys))
+    for i in range(0, len(unique_keys), 500):
+        chunk = unique_keys[i:i + 500]
+        placeholders = ",".join("?" * len(chunk))
+        rows = conn.execute(f"SELECT key, vec FROM embeddings WHERE key IN ({placeholders})", chunk)
+        for key, vec in rows:
+            cached[key] = np.frombuffer(vec, dtype=np.float32)
+    return cached
+
+
+def save_cached_embeddings(conn, keys, vectors):
+    """Store newly generated embeddings in the cache."""
+    rows = [(key, np.asarray(vec, dtype=np.float32).tobytes()) for key, vec in zip(keys, vectors)]
+    conn.executemany("INSERT OR REPLACE INTO embeddings (key, vec) VALUES (?, ?)", rows)
+    conn.commit()
+
+
+_rate_lock = threading.Lock()
+_next_request_time = 0.0
+
+
+def wait_for_rate_limit():
+    """Space embedding requests from all worker threads at most EMBED_REQUESTS_PER_SECOND apart."""
+    global _next_request_time
+    with _rate_lock:
+        now = time.monotonic()
+        wait = _next_request_time - now
+        _next_request_time = max(now, _next_request_time) + 1 / EMBED_REQUESTS_PER_SECOND
+    if wait > 0:
+        time.sleep(wait)
+
+
+def embed_batch(batch_texts):
+    """Embed one batch of texts, retrying with jittered backoff when rate limited."""
+    for attempt in range(EMBED_MAX_RETRIES):
+        wait_for_rate_limit()
+        try:
+            return vo.embed(batch_texts, model=EMBED_MODEL).embeddings
+        except voyageai.error.RateLimitError:
+            if attempt == EMBED_MAX_RETRIES - 1:
+                raise
+            time.sleep(2 ** attempt + random.random())
 
 
 def generate_text_embeddings(texts):
     """
-    Generate embeddings for a list of texts using VoyageAI in batches.
+    Generate embeddings for a list of texts using VoyageAI in concurrent batches.
+    Embeddings are cached on disk, so only texts not seen before are sent to the API.
     """
-    embeddings = []
     batch_size = 20
 
     clean_texts = [t for t in texts if t.strip()]
+    keys = [get_embedding_key(t) for t in clean_texts]
+
+    conn = open_embedding_cache()
+    try:
+        cached = load_cached_embeddings(conn, keys)
+        missing_idx = [idx for idx, key in enumerate(keys) if key not in cached]
+
+        batches = [missing_idx[i:i + batch_size] for i in range(0, len(missing_idx), batch_size)]
+        batch_texts = [[clean_texts[idx] for idx in batch_idx] for batch_idx in batches]
+
+        with ThreadPoolExecutor(max_workers=EMBED_MAX_WORKERS) as executor:
+            for batch_idx, batch_embeddings in zip(batches, executor.map(embed_batch, batch_texts)):
+                batch_keys = [keys[idx] for idx in batch_idx]
+                save_cached_embeddings(conn, batch_keys, batch_embeddings)
+                for key, vec in zip(batch_keys, batch_embeddings):
+                    cached[key] = np.asarray(vec, dtype=np.float32)
+    finally:
+        conn.close()
+
+    if not keys:
+        return np.empty((0, 0), dtype=np.float32)
+
+    dim = len(cached[keys[0]])
+    embeddings = np.empty((len(keys), dim), dtype=np.float32, order="C")
+    for row, key in enumerate(keys):
+        embeddings[row] = cached[key]
+    return embeddings
 
-    for i in range(0, len(clean_texts), batch_size):
-        batch_texts = clean_texts[i:i + batch_size]
-        if not batch_texts:
-            continue
 
-        result = vo.embed(batch_texts, model="voyage-3.5")
-        batch_embeddings = result.embeddings
-        embeddings.extend(batch_embeddings)
+def fit_profile_transformer(profile_feats):
+    """
+    Build the profile feature transformer: numeric fields are mean-imputed and standardized,
+    categorical fields one-hot encoded into a sparse matrix.
+    The fitted transformer is persisted and reused while the profile data is unchanged.
+    """
+    fingerprint = hashlib.sha256(
+        pd.util.hash_pandas_object(profile_feats, index=False).values.tobytes()
+        + ",".join(profile_feats.columns).encode()
+    ).hexdigest()
+
+    if os.path.exists(PROFILE_TRANSFORMER_PATH):
+        with open(PROFILE_TRANSFORMER_PATH, "rb") as f:
+            saved_fingerprint, transformer = pickle.load(f)
+        if saved_fingerprint == fingerprint:
+            return transformer
+
+    num_cols = profile_feats.select_dtypes(include=['number', 'bool']).columns.tolist()
+    cat_cols = [c for c in profile_feats.columns if c not in num_cols]
+
+    transformer = ColumnTransformer(
+        [
+            ("num", make_pipeline(SimpleImputer(strategy="mean"), StandardScaler()), num_cols),
+            ("cat", OneHotEncoder(sparse_output=True, handle_unknown="ignore", dtype=np.float32), cat_cols),
+        ],
+        sparse_threshold=1.0
+    )
+    transformer.fit(profile_feats)
 
-    return np.array(embeddings)
+    with open(PROFILE_TRANSFORMER_PATH, "wb") as f:
+        pickle.dump((fingerprint, transformer), f)
+    return transformer
 
 
 def combine_with_profiles(embeddings, texts_df, profiles_df):
     """
     Combine text embeddings with fan profile features to create hybrid embeddings.
+    Profile fields are encoded with fit_profile_transformer; the result is a sparse CSR matrix.
     """
     filtered_texts_df = texts_df[texts_df['text'].str.strip().astype(bool)].reset_index(drop=True)
 
@@ -75,27 +221,63 @@ def combine_with_profiles(embeddings, texts_df, profiles_df):
 
     drop_cols = ['fan_model_id', 'stage', 'text']
     profile_feats = merged.drop(columns=drop_cols, errors='ignore')
-    profile_feats = pd.get_dummies(profile_feats)
-    profile_feats = (profile_feats - profile_feats.mean()) / (profile_feats.std() + 1e-6)
+    profile_feats = profile_feats.astype({
+        c: object for c in profile_feats.columns if not pd.api.types.is_numeric_dtype(profile_feats[c])
+    })
 
-    hybrid = np.hstack([embeddings, profile_feats.fillna(0).values])
+    transformer = fit_profile_transformer(profile_feats)
+    profile_matrix = transformer.transform(profile_feats)
+
+    hybrid = sparse.hstack(
+        [sparse.csr_matrix(embeddings), profile_matrix],
+        format="csr", dtype=np.float32
+    )
     return hybrid, merged
 
 
+def make_kmeans(n_samples):
+    """
+    Create the KMeans estimator, using cuML on GPU when available
+    and MiniBatchKMeans on CPU for large inputs.
+    """
+    if HAS_CUML:
+        return cuKMeans(n_clusters=N_CLUSTERS, random_state=42)
+    if n_samples > MINIBATCH_THRESHOLD:
+        return MiniBatchKMeans(n_clusters=N_CLUSTERS, batch_size=1024, n_init="auto", random_state=42)
+    return KMeans(n_clusters=N_CLUSTERS, random_state=42)
+
+
+def make_umap(**kwargs):
+    """
+    Create the UMAP reducer, using cuML on GPU when available.
+    """
+    if HAS_CUML:
+        return cuUMAP(random_state=42, **kwargs)
+    return umap.UMAP(random_state=42, **kwargs)
+
+
 def cluster_and_plot(embeddings, df, method="A"):
     """
-    Cluster embeddings using KMeans, reduce with UMAP, and create 2D and 3D visualizations.
+    Cluster embeddings using KMeans, reduce with a single 3-component UMAP fit,
+    and create 2D (x, y) and 3D (x, y, z) visualizations.
     """
-    if len(df) != len(embeddings):
-        df = df.iloc[:len(embeddings)].reset_index(drop=True)
+    n_rows = embeddings.shape[0]
+    if len(df) != n_rows:
+        df = df.iloc[:n_rows].reset_index(drop=True)
 
-    kmeans = KMeans(n_clusters=N_CLUSTERS, random_state=42)
-    df["cluster"] = kmeans.fit_predict(embeddings)
+    if HAS_CUML:
+        if sparse.issparse(embeddings):
+            embeddings = embeddings.toarray()
+        embeddings = embeddings.astype(np.float32)
 
-    reducer = umap.UMAP(n_neighbors=10, min_dist=0.1, random_state=42)
+    kmeans = make_kmeans(n_rows)
+    labels = kmeans.fit_predict(embeddings)
+
+    reducer = make_umap(n_neighbors=10, min_dist=0.1, n_components=3)
     reduced = reducer.fit_transform(embeddings)
-    df["x"] = reduced[:, 0]
-    df["y"] = reduced[:, 1]
+
+    # assign() returns a new frame, so the caller's df is left untouched
+    df = df.assign(cluster=labels, x=reduced[:, 0], y=reduced[:, 1], z=reduced[:, 2])
 
     plt.figure(figsize=(10, 6))
     sns.scatterplot(data=df, x="x", y="y", hue="cluster", palette="Set2")
@@ -104,8 +286,8 @@ def cluster_and_plot(embeddings, df, method="A"):
     plt.close()
 
     fig3d = px.scatter_3d(
-        df.assign(z=reduced[:, 0]),
-        x="x", y="y", z="z" if "z" in df else "x",
+        df,
+        x="x", y="y", z="z",
         color="cluster",
         hover_data=["fan_model_id", "stage"]
     )
@@ -116,18 +298,50 @@ def cluster_and_plot(embeddings, df, method="A"):
     return df, kmeans
 
 
+def to_npz_records(meta_df):
+    """
+    Convert key columns to a record array with fixed-width unicode text columns,
+    so the npz can be loaded without allow_pickle.
+    """
+    columns = []
+    for col in meta_df.columns:
+        values = meta_df[col]
+        if pd.api.types.is_numeric_dtype(values):
+            columns.append(values.to_numpy())
+        else:
+            columns.append(values.astype(str).to_numpy().astype("U"))
+    return np.rec.fromarrays(columns, names=[str(col) for col in meta_df.columns])
+
+
 def save_embeddings(filename, embeddings, meta_df):
     """
-    Save embeddings and metadata as a pickle file.
+    Save float16 embeddings with their (fan_model_id, stage) keys as a compressed npz file,
+    and the full metadata (texts, profile fields) as a parquet file next to it.
+    Sparse (hybrid) embeddings are stored as their CSR components.
     """
-    with open(f"outputs/{filename}", "wb") as f:
-        pickle.dump((embeddings, meta_df), f)
+    path = Path("outputs") / filename
+    keys = to_npz_records(meta_df[["fan_model_id", "stage"]])
+    if sparse.issparse(embeddings):
+        embeddings = embeddings.tocsr()
+        np.savez_compressed(
+            path,
+            data=embeddings.data.astype(np.float16),
+            indices=embeddings.indices,
+            indptr=embeddings.indptr,
+            shape=embeddings.shape,
+            keys=keys
+        )
+    else:
+        np.savez_compressed(path, emb=embeddings.astype(np.float16), keys=keys)
+
+    meta_df.to_parquet(path.with_suffix(".meta.parquet"), index=False)
 
 
 def main():
     """
     Main pipeline to process data, generate embeddings, cluster, and save outputs.
     """
+    enable_copy_on_write()
     Path("outputs").mkdir(exist_ok=True)
     staged_df, profiles_df = load_data()
 
@@ -135,17 +349,17 @@ def main():
 
     print("🔹 Method A: Generating embeddings without profile info...")
     methodA_embeddings = generate_text_embeddings(texts_df["text"].tolist())
-    save_embeddings("embeddings_without_profile.pkl", methodA_embeddings, texts_df)
+    save_embeddings("embeddings_without_profile.npz", methodA_embeddings, texts_df)
 
     print("📊 Clustering Method A...")
-    dfA, _ = cluster_and_plot(methodA_embeddings, texts_df.copy(), method="A")
+    dfA, _ = cluster_and_plot(methodA_embeddings, texts_df, method="A")
 
     print("🔹 Method B: Combining with fan profiles...")
     methodB_embeddings, hybrid_df = combine_with_profiles(methodA_embeddings, texts_df, profiles_df)
-    save_embeddings("embeddings_with_profile.pkl", methodB_embeddings, hybrid_df)
+    save_embeddings("embeddings_with_profile.npz", methodB_embeddings, hybrid_df)
 
     print("📊 Clustering Method B...")
-    dfB, _ = cluster_and_plot(methodB_embeddings, hybrid_df.copy(), method="B")
+    dfB, _ = cluster_and_plot(methodB_embeddings, hybrid_df, method="B")
 
     print("✅ All clustering done. Check the outputs folder.")
 
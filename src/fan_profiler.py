@@ -9,40 +9,92 @@ import pandas as pd
 import hashlib
 import os
 import json
-import time
-from tqdm import tqdm
+import sqlite3
+import asyncio
+from tqdm.asyncio import tqdm_asyncio
 from pathlib import Path
-import re
-from openai import OpenAI
+from segmentation import enable_copy_on_write, make_fan_model_id
+from openai import AsyncOpenAI
 
 MODEL = "gpt-4o"
 BATCH_SIZE = 20
-CACHE_DIR = "cache/llm_cache"
-os.makedirs(CACHE_DIR, exist_ok=True)
+MAX_CONCURRENT_REQUESTS = 5
+CACHE_PATH = "cache/llm_cache.sqlite"
+LEGACY_CACHE_DIR = "cache/llm_cache"
+os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
 
 
 def get_hash(text):
-    """Generate MD5 hash for caching."""
-    return hashlib.md5(text.encode()).hexdigest()
+    """Generate SHA256 hash for caching."""
+    return hashlib.sha256(text.encode()).digest()
 
 
-def load_cache(hash_key):
-    """Load cached profile if exists."""
-    path = os.path.join(CACHE_DIR, hash_key + ".json")
+def open_cache():
+    """Open the on-disk profile cache, creating the table if needed."""
+    conn = sqlite3.connect(CACHE_PATH)
+    conn.execute("CREATE TABLE IF NOT EXISTS profiles (key BLOB PRIMARY KEY, profile BLOB)")
+    return conn
+
+
+def load_cache(conn, hash_keys):
+    """Load cached profiles for a batch of keys; returns a dict of key -> profile."""
+    if not hash_keys:
+        return {}
+    placeholders = ",".join("?" * len(hash_keys))
+    rows = conn.execute(f"SELECT key, profile FROM profiles WHERE key IN ({placeholders})", hash_keys)
+    return {key: json.loads(profile) for key, profile in rows}
+
+
+def load_legacy_cache(text):
+    """Load a profile from the old one-JSON-file-per-fan cache if it exists."""
+    path = os.path.join(LEGACY_CACHE_DIR, hashlib.md5(text.encode()).hexdigest() + ".json")
     if os.path.exists(path):
         with open(path, "r") as f:
             return json.load(f)
     return None
 
 
-def save_cache(hash_key, response):
-    """Save profile to cache."""
-    path = os.path.join(CACHE_DIR, hash_key + ".json")
-    with open(path, "w") as f:
-        json.dump(response, f)
-
-
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+def save_cache(conn, items):
+    """Save a batch of (hash_key, profile) pairs to cache."""
+    rows = [(key, json.dumps(profile).encode()) for key, profile in items]
+    conn.executemany("INSERT OR REPLACE INTO profiles (key, profile) VALUES (?, ?)", rows)
+    conn.commit()
+
+
+client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+
+PROFILE_FIELDS = [
+    "age_indicators",
+    "job_or_career",
+    "location_hints",
+    "relationship_status",
+    "personality_traits",
+    "emotional_needs",
+    "purchase_motivations",
+    "communication_style",
+    "life_events",
+]
+
+PROFILE_SCHEMA = {
+    "name": "fan_profiles",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "profiles": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {field: {"type": "array", "items": {"type": "string"}} for field in PROFILE_FIELDS},
+                    "required": PROFILE_FIELDS,
+                    "additionalProperties": False,
+                },
+            },
+        },
+        "required": ["profiles"],
+        "additionalProperties": False,
+    },
+}
 
 
 def normalize_keys(profile_dict):
@@ -63,42 +115,33 @@ def normalize_keys(profile_dict):
     return {key_map.get(k, k): v for k, v in profile_dict.items()}
 
 
-def call_llm_batch(conversations_list):
+async def call_llm_batch(conversations_list):
     """
     Call LLM to generate profiles for a batch of fans.
+    The response is constrained to PROFILE_SCHEMA, so it can be parsed directly.
     """
     batch_prompt = "You're a fan profiler for a premium chat platform.\n\n"
     batch_prompt += "For each fan conversation, extract:\n- Age indicators\n- Job or career\n- Location hints\n- Relationship status\n- Personality traits\n- Emotional needs\n- Purchase motivations\n- Communication style\n- Life events\n\n"
-    batch_prompt += "Return ONLY a JSON array of objects, one object per fan, no commentary, no markdown.\n\n"
+    batch_prompt += "Return one profile per fan, in the same order as the fans below.\n\n"
 
     for i, conv in enumerate(conversations_list, start=1):
         batch_prompt += f"Fan #{i} messages:\n{conv}\n\n"
 
-    response = client.chat.completions.create(
+    response = await client.chat.completions.create(
         model=MODEL,
         messages=[
-            {"role": "system", "content": "You are an expert profiler. Your output must be ONLY a JSON array. No explanation or text."},
+            {"role": "system", "content": "You are an expert profiler."},
             {"role": "user", "content": batch_prompt}
-        ]
+        ],
+        response_format={"type": "json_schema", "json_schema": PROFILE_SCHEMA}
     )
 
     content = response.choices[0].message.content
 
     try:
-        match = re.search(r"\[.*\]", content, re.DOTALL)
-        if match:
-            json_str = match.group(0)
-            json_str = json_str.strip("`")
-            json_str = re.sub(r",\s*([\]}])", r"\1", json_str)
-            profiles = json.loads(json_str)
-        else:
-            print("⚠️ No JSON array found in LLM response. Full content below:")
-            print("----- RAW LLM RESPONSE -----")
-            print(content)
-            print("----------------------------")
-            profiles = [{} for _ in conversations_list]
-    except Exception as e:
-        print(f"⚠️ Failed to parse JSON array: {e}")
+        profiles = json.loads(content)["profiles"]
+    except (TypeError, KeyError, json.JSONDecodeError) as e:
+        print(f"⚠️ Failed to parse JSON response: {e}")
         print("----- RAW LLM RESPONSE -----")
         print(content)
         print("----------------------------")
@@ -107,12 +150,40 @@ def call_llm_batch(conversations_list):
     return profiles
 
 
+async def profile_batch(batch_texts, batch_ids, batch_keys, semaphore):
+    """
+    Profile one batch of uncached fans; returns (hash_key, profile) pairs.
+    Failed batches get empty profiles with no hash_key, so they are not cached.
+    """
+    async with semaphore:
+        try:
+            new_profiles = await call_llm_batch(batch_texts)
+        except Exception as e:
+            print(f"❌ Failed profiling batch of {len(batch_ids)} fans: {e}")
+            return [(None, {"fan_model_id": fan_id}) for fan_id in batch_ids]
+
+    items = []
+    for prof, fan_id, hash_key in zip(new_profiles, batch_ids, batch_keys):
+        prof = normalize_keys(prof)
+        prof['fan_model_id'] = fan_id
+        items.append((hash_key, prof))
+    return items
+
+
+async def profile_uncached(batches):
+    """
+    Run all uncached batches concurrently, bounded by MAX_CONCURRENT_REQUESTS.
+    """
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    coros = [profile_batch(texts, ids, keys, semaphore) for texts, ids, keys in batches]
+    return await tqdm_asyncio.gather(*coros, desc="Profiling fans")
+
+
 def profile_fans(convos_df):
     """
-    Main profiling function: loops through fans, caches results, calls LLM.
+    Main profiling function: loops through fans, caches results, calls LLM concurrently for uncached batches.
     """
-    profiles = []
-    fan_groups = list(convos_df.groupby("fan_model_id"))
+    fan_groups = list(convos_df.groupby("fan_model_id", sort=False, observed=True))
 
     all_fan_texts = []
     fan_ids = []
@@ -122,51 +193,59 @@ def profile_fans(convos_df):
         all_fan_texts.append(all_fan_text)
         fan_ids.append(fan_id)
 
-    for i in tqdm(range(0, len(all_fan_texts), BATCH_SIZE), desc="Profiling fans"):
-        batch_texts = all_fan_texts[i:i + BATCH_SIZE]
-        batch_ids = fan_ids[i:i + BATCH_SIZE]
-
-        to_query_texts = []
-        to_query_ids = []
-        final_batch_profiles = []
-
-        for text, fan_id in zip(batch_texts, batch_ids):
-            hash_key = get_hash(text)
-            cached = load_cache(hash_key)
-            if cached:
-                cached = normalize_keys(cached)
-                cached['fan_model_id'] = fan_id
-                final_batch_profiles.append(cached)
-            else:
-                to_query_texts.append(text)
-                to_query_ids.append(fan_id)
+    all_keys = [get_hash(text) for text in all_fan_texts]
+    profiles = [None] * len(fan_ids)
+
+    to_query_idx = []
+    migrated = []
+
+    conn = open_cache()
+    try:
+        for i in range(0, len(all_fan_texts), BATCH_SIZE):
+            cached_profiles = load_cache(conn, all_keys[i:i + BATCH_SIZE])
+
+            for idx in range(i, min(i + BATCH_SIZE, len(all_fan_texts))):
+                cached = cached_profiles.get(all_keys[idx])
+                if not cached:
+                    cached = load_legacy_cache(all_fan_texts[idx])
+                    if cached:
+                        migrated.append((all_keys[idx], cached))
+                if cached:
+                    cached = normalize_keys(cached)
+                    cached['fan_model_id'] = fan_ids[idx]
+                    profiles[idx] = cached
+                else:
+                    to_query_idx.append(idx)
+
+        if migrated:
+            save_cache(conn, migrated)
 
         # Query LLM for uncached
-        if to_query_texts:
-            try:
-                new_profiles = call_llm_batch(to_query_texts)
-                for prof, fan_id, text in zip(new_profiles, to_query_ids, to_query_texts):
-                    prof = normalize_keys(prof)
-                    prof['fan_model_id'] = fan_id
-                    hash_key = get_hash(text)
-                    save_cache(hash_key, prof)
-                    final_batch_profiles.append(prof)
-            except Exception as e:
-                print(f"❌ Failed profiling batch starting at index {i}: {e}")
-                for fan_id in to_query_ids:
-                    final_batch_profiles.append({"fan_model_id": fan_id})
-
-        profiles.extend(final_batch_profiles)
-
-        # Pause
-        time.sleep(2)
-
-    return pd.DataFrame(profiles)
+        batches = [to_query_idx[i:i + BATCH_SIZE] for i in range(0, len(to_query_idx), BATCH_SIZE)]
+        if batches:
+            results = asyncio.run(profile_uncached([
+                (
+                    [all_fan_texts[idx] for idx in batch_idx],
+                    [fan_ids[idx] for idx in batch_idx],
+                    [all_keys[idx] for idx in batch_idx],
+                )
+                for batch_idx in batches
+            ]))
+            for batch_idx, items in zip(batches, results):
+                save_cache(conn, [(hash_key, prof) for hash_key, prof in items if hash_key is not None])
+                for idx, (_, prof) in zip(batch_idx, items):
+                    profiles[idx] = prof
+    finally:
+        conn.close()
+
+    return pd.DataFrame([prof for prof in profiles if prof is not None])
+
 
 def main():
     """
     Main pipeline to load conversation data, profile fans, and save results.
     """
+    enable_copy_on_write()
     raw = pd.read_pickle("data/HOMEWORK_LOGS.pkl")
 
     raw = raw.rename(columns={
@@ -175,7 +254,7 @@ def main():
         'purchased': 'purchase'
     })
 
-    raw['fan_model_id'] = raw['fan_id'].astype(str) + "_" + raw['model_id'].astype(str)
+    raw['fan_model_id'] = make_fan_model_id(raw)
 
     # Profile the fans
     fan_profiles = profile_fans(raw)
@@ -10,6 +10,15 @@ from datetime import timedelta
 from pathlib import Path
 
 
+def enable_copy_on_write():
+    """
+    Turn on pandas Copy-on-Write so derived frames share memory until written.
+    It is always on from pandas 3.0, where the option is deprecated.
+    """
+    if int(pd.__version__.split(".")[0]) < 3:
+        pd.options.mode.copy_on_write = True
+
+
 def load_data(file_path):
     """
     Load data from pickle file.
@@ -17,26 +26,50 @@ def load_data(file_path):
     return pd.read_pickle(file_path)
 
 
+def make_fan_model_id(df):
+    """
+    Build fan_model_id as a categorical "<fan_id>_<model_id>" label.
+    Labels are formatted once per unique (fan_id, model_id) pair; missing ids format as "nan"
+    and pairs that format to the same label share one category.
+    """
+    pair_codes, pairs = pd.MultiIndex.from_arrays([df['fan_id'], df['model_id']]).factorize()
+    labels = pd.Index([f"{fan}_{model}" for fan, model in pairs])
+    categories = labels.unique().sort_values()
+    codes = categories.get_indexer(labels)[pair_codes]
+    return pd.Categorical.from_codes(codes, categories=categories)
+
+
+def parse_flag(flag):
+    """
+    Parse a boolean flag column (e.g. purchase, is_system) into bool;
+    only True/1 and their string forms count as True, missing values as False.
+    """
+    if flag.dtype == bool:
+        return flag
+    return flag.isin([True, 1, 'True', 'TRUE', 'true', '1'])
+
+
 def preprocess(df):
     """
     Clean and prepare dataframe by renaming columns, parsing timestamps, and creating fan_model_id.
     """
-    df = df.copy()
-
     df = df.rename(columns={
         'model_name': 'model_id',
         'datetime': 'timestamp',
         'purchased': 'purchase'
     })
 
-    df['purchase'] = df['purchase'].astype(str).str.upper().map({'TRUE': True, 'FALSE': False, '1': True, '0': False}).fillna(False)
+    for col in ('fan_id', 'model_id'):
+        df[col] = df[col].astype('category')
+
+    df['purchase'] = parse_flag(df['purchase'])
 
     if 'is_system' in df.columns:
-        df = df[~df['is_system']]
+        df = df[~parse_flag(df['is_system'])]
 
     df['timestamp'] = pd.to_datetime(df['timestamp'])
 
-    df['fan_model_id'] = df['fan_id'].astype(str) + "_" + df['model_id'].astype(str)
+    df['fan_model_id'] = make_fan_model_id(df)
 
     df = df.sort_values(by=['fan_model_id', 'timestamp'])
 
@@ -46,20 +79,17 @@ def preprocess(df):
 def assign_conversations(df):
     """
     Assign conversation IDs based on time gaps and model switches.
+    Expects df sorted by fan_model_id and timestamp (as returned by preprocess),
+    so every fan-model run is contiguous and can be scanned in a single pass.
     """
-    df = df.copy()
-    df['new_convo'] = False
-
-    df['prev_model'] = df.groupby('fan_model_id')['model_id'].shift(1)
-    df['prev_time'] = df.groupby('fan_model_id')['timestamp'].shift(1)
-    
-    time_diff = df['timestamp'] - df['prev_time']
-    model_switch = df['model_id'] != df['prev_model']
-    time_gap = time_diff > timedelta(hours=4)
-
-    df.loc[model_switch | time_gap, 'new_convo'] = True
-    df['convo_id'] = df.groupby('fan_model_id')['new_convo'].cumsum()
-    df['conversation_id'] = df['fan_model_id'] + "_C" + df['convo_id'].astype(str)
+    fan_model_id = df['fan_model_id']
+    model_switch = fan_model_id != fan_model_id.shift(1)
+    time_gap = df['timestamp'].diff() > timedelta(hours=4)
+
+    df = df.assign(new_convo=model_switch | time_gap)
+    convo_count = df['new_convo'].cumsum()
+    df['convo_id'] = convo_count - convo_count.where(model_switch).ffill().astype('int64') + 1
+    df['conversation_id'] = df['fan_model_id'].astype(str) + "_C" + df['convo_id'].astype(str)
     return df
 
 
@@ -67,50 +97,55 @@ def compute_features(df):
     """
     Compute conversation-level features such as purchase stats, durations, and activity indicators.
     """
-    features = []
-    grouped = df.groupby('conversation_id')
-    for convo_id, group in grouped:
-        revenue = group['purchase'].sum()
-        purchases = group['purchase'].sum()
-        purchase_msgs = group[group['purchase']]
-        purchase_rate = purchases / len(group)
-        time_to_first_purchase = (
-            (purchase_msgs['timestamp'].iloc[0] - group['timestamp'].iloc[0]).total_seconds() / 3600
-            if not purchase_msgs.empty else None
-        )
-        duration = (group['timestamp'].iloc[-1] - group['timestamp'].iloc[0]).total_seconds() / 3600
-        days_between = (
-            (purchase_msgs['timestamp'].iloc[-1] - purchase_msgs['timestamp'].iloc[0]).days
-            if len(purchase_msgs) > 1 else 0
-        )
-        last_msg_time = group['timestamp'].max()
-        active = (df['timestamp'].max() - last_msg_time).days < 2
-        msgs_before_first_purchase = (
-            purchase_msgs.index[0] - group.index[0] if not purchase_msgs.empty else len(group)
-        )
-
-        features.append({
-            'conversation_id': convo_id,
-            'fan_model_id': group['fan_model_id'].iloc[0],
-            'message_count': len(group),
-            'revenue': revenue,
-            'purchase_count': purchases,
-            'purchase_rate': purchase_rate,
-            'duration_hours': duration,
-            'messages_before_first_purchase': msgs_before_first_purchase,
-            'time_to_first_purchase_hrs': time_to_first_purchase,
-            'days_between_first_last_purchase': days_between,
-            'active': active,
-            'days_since_last_message': (df['timestamp'].max() - last_msg_time).days
-        })
-
-    return pd.DataFrame(features)
+    dataset_max = df['timestamp'].max()
+    row_idx = df.index.to_series()
+
+    agg = df.groupby('conversation_id', sort=False).agg(
+        fan_model_id=('fan_model_id', 'first'),
+        message_count=('purchase', 'size'),
+        purchase_count=('purchase', 'sum'),
+        first_ts=('timestamp', 'first'),
+        last_ts=('timestamp', 'last'),
+        last_msg_time=('timestamp', 'max'),
+    )
+    agg['first_idx'] = row_idx.groupby(df['conversation_id'], sort=False).first()
+
+    purchase_msgs = df[df['purchase']]
+    purchase_agg = purchase_msgs.groupby('conversation_id', sort=False).agg(
+        first_purchase_ts=('timestamp', 'first'),
+        last_purchase_ts=('timestamp', 'last'),
+    )
+    purchase_agg['first_purchase_idx'] = row_idx[df['purchase']].groupby(purchase_msgs['conversation_id'], sort=False).first()
+    agg = agg.join(purchase_agg)
+
+    has_purchase = agg['first_purchase_ts'].notna()
+
+    out = agg[['fan_model_id', 'message_count']].reset_index()
+    out['revenue'] = agg['purchase_count'].values
+    out['purchase_count'] = agg['purchase_count'].values
+    out['purchase_rate'] = (agg['purchase_count'] / agg['message_count']).values
+    out['duration_hours'] = ((agg['last_ts'] - agg['first_ts']).dt.total_seconds() / 3600).values
+    out['messages_before_first_purchase'] = (
+        (agg['first_purchase_idx'] - agg['first_idx']).where(has_purchase, agg['message_count']).astype('int64').values
+    )
+    out['time_to_first_purchase_hrs'] = (
+        (agg['first_purchase_ts'] - agg['first_ts']).dt.total_seconds() / 3600
+    ).values
+    out['days_between_first_last_purchase'] = (
+        (agg['last_purchase_ts'] - agg['first_purchase_ts']).dt.days.fillna(0).astype('int64').values
+    )
+    days_since_last_message = (dataset_max - agg['last_msg_time']).dt.days
+    out['active'] = (days_since_last_message < 2).values
+    out['days_since_last_message'] = days_since_last_message.values
+
+    return out
 
 
 def main():
     """
     Main pipeline to load, preprocess, assign conversations, compute features, and save outputs.
     """
+    enable_copy_on_write()
     raw = load_data("data/HOMEWORK_LOGS.pkl")
     clean = preprocess(raw)
     convos = assign_conversations(clean)
@@ -5,8 +5,10 @@ assigns them to engagement stages based on purchase timing,
 and saves the segmented DataFrame for downstream analysis.
 """
 
+import numpy as np
 import pandas as pd
 from pathlib import Path
+from segmentation import enable_copy_on_write, make_fan_model_id, parse_flag
 
 
 def load_data():
@@ -25,8 +27,12 @@ def load_data():
         'purchased': 'purchase'
     })
 
+    for col in ('fan_id', 'model_id'):
+        df[col] = df[col].astype('category')
+
+    df['purchase'] = parse_flag(df['purchase'])
     df['timestamp'] = pd.to_datetime(df['timestamp'])
-    df['fan_model_id'] = df['fan_id'].astype(str) + "_" + df['model_id'].astype(str)
+    df['fan_model_id'] = make_fan_model_id(df)
     df = df.sort_values(by=['fan_model_id', 'timestamp'])
     return df
 
@@ -41,47 +47,26 @@ def assign_stages(df):
     Returns:
         pd.DataFrame: DataFrame with added 'stage' column indicating engagement stage.
     """
-    all_stage_rows = []
-
-    for fan_model_id, group in df.groupby("fan_model_id"):
-        group = group.sort_values(by="timestamp")
-        purchase_times = group[group["purchase"] == True]["timestamp"].tolist()
-
-        if not purchase_times:
-            group["stage"] = "stage_1"
-            all_stage_rows.append(group)
-            continue
-
-        first_purchase = purchase_times[0]
-        last_purchase = purchase_times[-1]
-
-        stage1 = group[group["timestamp"] <= first_purchase].copy()
-        stage1["stage"] = "stage_1"
-
-        if first_purchase != last_purchase:
-            stage2 = group[(group["timestamp"] > first_purchase) & (group["timestamp"] <= last_purchase)].copy()
-            stage2["stage"] = "stage_2"
-        else:
-            stage2 = pd.DataFrame(columns=group.columns)
-
-        stage3 = group[group["timestamp"] > last_purchase].copy()
-        stage3["stage"] = "stage_3"
-
-        all_parts = [stage1]
-        if not stage2.empty:
-            all_parts.append(stage2)
-        if not stage3.empty:
-            all_parts.append(stage3)
-
-        all_stage_rows.append(pd.concat(all_parts))
+    purchase_times = df["timestamp"].where(df["purchase"] == True)
+    by_fan = purchase_times.groupby(df["fan_model_id"], sort=False, observed=True)
+    first_purchase = by_fan.transform("min")
+    last_purchase = by_fan.transform("max")
 
-    return pd.concat(all_stage_rows)
+    return df.assign(stage=np.select(
+        [
+            first_purchase.isna() | (df["timestamp"] <= first_purchase),
+            df["timestamp"] <= last_purchase,
+        ],
+        ["stage_1", "stage_2"],
+        default="stage_3",
+    ))
 
 
 def main():
     """
     Main execution: load data, assign stages, and save staged DataFrame.
     """
+    enable_copy_on_write()
     df = load_data()
     staged_df = assign_stages(df)
 